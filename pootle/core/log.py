@@ -40,9 +40,14 @@ UNMUTE_QUALITYCHECK = 'QU'
 SCORE_CHANGED = 'SC'
 
 
-def log(message):
+def log(message, *args):
+    """Log `message` to the action log.
+
+    Any `args` are interpolated into `message` by the logging framework,
+    i.e. only when the message is actually emitted.
+    """
     logger = logging.getLogger('action')
-    logger.info(message)
+    logger.info(message, *args)
 
 
 def action_log(*args, **kwargs):
@@ -26,6 +26,8 @@ import logging
 
 from datetime import datetime
 from functools import wraps
+from itertools import chain, imap
+from operator import itemgetter
 
 from translate.filters.decorators import Category
 
@@ -40,22 +42,35 @@ from django_rq.queues import get_connection
 from pootle.core.log import log
 from pootle.core.url_helpers import get_all_pootle_paths, split_pootle_path
 from pootle_misc.checks import get_qualitychecks_by_category
-from pootle_misc.util import datetime_min, dictsum
+from pootle_misc.util import datetime_min
 
 
 POOTLE_DIRTY_TREEITEMS = 'pootle:dirty:treeitems'
 POOTLE_REFRESH_STATS = 'pootle:refresh:stats'
 
+# Comma-separated critical quality check names, see `get_critical_url()`
+_critical_checks = None
+
 
 def statslog(function):
+    logger = logging.getLogger('action')
+
     @wraps(function)
     def _statslog(instance, *args, **kwargs):
+        if not logger.isEnabledFor(logging.INFO):
+            # Nothing would be logged, skip timing the call
+            return function(instance, *args, **kwargs)
+
         start = datetime.now()
         result = function(instance, *args, **kwargs)
         end = datetime.now()
-        log("%s(%s)\t%s\t%s" % (function.__name__, ', '.join(args), end - start,
-                                instance.get_cachekey()))
+        log("%s(%s)\t%s\t%s", function.__name__, ', '.join(args),
+            end - start, instance.get_cachekey())
         return result
+
+    # `functools.wraps` doesn't set this in Python 2
+    _statslog.__wrapped__ = function
+
     return _statslog
 
 
@@ -74,8 +89,59 @@ class CachedMethods(object):
 
     @classmethod
     def get_all(self):
-        return [getattr(self, x) for x in
-                filter(lambda x: x[:2] != '__' and x != 'get_all', dir(self))]
+        return self._ALL
+
+
+# The method names never change at runtime, so collect them only once
+CachedMethods._ALL = tuple(
+    getattr(CachedMethods, x) for x in dir(CachedMethods)
+    if x[:1] != '_' and x != 'get_all'
+)
+
+
+# Cached methods used to build `get_stats()` results
+STATS_METHODS = (
+    CachedMethods.TOTAL,
+    CachedMethods.TRANSLATED,
+    CachedMethods.FUZZY,
+    CachedMethods.SUGGESTIONS,
+    CachedMethods.LAST_ACTION,
+    CachedMethods.CHECKS,
+    CachedMethods.LAST_UPDATED,
+)
+
+
+def get_many_cached(items, names, from_update=False):
+    """Get cached `names` values for all `items` in a single cache request.
+
+    :return: a list with a `{name: value}` dict for each of `items`.
+    """
+    items_keys = [item._get_cachekeys(names) for item in items]
+    values = cache.get_many([key for keys in items_keys
+                             for key in keys.itervalues()])
+
+    return [
+        dict((name, item._get_cached_or_initial(name, values.get(key),
+                                                from_update))
+             for name, key in keys.iteritems())
+        for item, keys in zip(items, items_keys)
+    ]
+
+
+def get_many_dirty(items):
+    """Check which of `items` are dirty in a single Redis request.
+
+    :return: a list with the dirty state of each of `items`.
+    """
+    pipe = get_connection().pipeline(transaction=False)
+    pipe.get(POOTLE_REFRESH_STATS)
+    for item in items:
+        pipe.zscore(POOTLE_DIRTY_TREEITEMS, item.get_cachekey())
+    results = pipe.execute()
+
+    refresh_path = results[0]
+    return [score > 0 or item._is_being_refreshed(refresh_path)
+            for item, score in zip(items, results[1:])]
 
 
 class TreeItem(object):
@@ -99,6 +165,10 @@ class TreeItem(object):
         """This method will be overridden in descendants"""
         raise NotImplementedError('`get_cachekey()` not implemented')
 
+    def _get_code(self, item):
+        """This method will be overridden in descendants"""
+        return item.code
+
     @classmethod
     def _get_total_wordcount(self):
         """This method will be overridden in descendants"""
@@ -126,7 +196,10 @@ class TreeItem(object):
 
     @classmethod
     def _get_last_action(self):
-        """This method will be overridden in descendants"""
+        """This method will be overridden in descendants.
+
+        Overrides must always return the `mtime` key.
+        """
         return {'id': 0, 'mtime': 0, 'snippet': ''}
 
     @classmethod
@@ -136,7 +209,10 @@ class TreeItem(object):
 
     @classmethod
     def _get_last_updated(self):
-        """This method will be overridden in descendants"""
+        """This method will be overridden in descendants.
+
+        Overrides must always return the `creation_time` key.
+        """
         return {'id': 0, 'creation_time': 0, 'snippet': ''}
 
     def is_dirty(self):
@@ -154,93 +230,113 @@ class TreeItem(object):
             self.initialize_children()
         return self._children
 
-    def _calc_sum(self, name, from_update):
-        self.initialize_children()
+    def _calc_sum(self, name, values):
         method = getattr(self, '_%s' % name)
-        return (method() +
-                sum([item.get_cached(name, from_update)
-                     for item in self.children]))
+        return method() + sum(values)
 
-    def _calc_last_action(self, from_update):
-        self.initialize_children()
+    def _calc_last_action(self, values):
+        return max(chain([self._get_last_action()], values),
+                   key=itemgetter('mtime'))
 
-        return max(
-            [self._get_last_action()] +
-            [item.get_cached(CachedMethods.LAST_ACTION, from_update)
-             for item in self.children],
-            key=lambda x: x['mtime'] if 'mtime' in x else 0
-        )
-
-    def _calc_mtime(self, from_update):
+    def _calc_mtime(self, values):
         """get latest modification time"""
-        self.initialize_children()
-        return max(
-            [self._get_mtime()] +
-            [item.get_cached(CachedMethods.MTIME, from_update)
-             for item in self.children]
-        )
+        return max(chain([self._get_mtime()], values))
 
-    def _calc_last_updated(self, from_update):
+    def _calc_last_updated(self, values):
         """get last updated"""
-        self.initialize_children()
-        return max(
-            [self._get_last_updated()] +
-            [item.get_cached(CachedMethods.LAST_UPDATED, from_update)
-             for item in self.children],
-            key=lambda x: x['creation_time'] if 'creation_time' in x else 0
-        )
+        return max(chain([self._get_last_updated()], values),
+                   key=itemgetter('creation_time'))
 
-    def _calc_checks(self, from_update):
+    def _calc_checks(self, values):
         result = self._get_checks()
-        self.initialize_children()
-        for item in self.children:
-            item_res = item.get_cached(CachedMethods.CHECKS, from_update)
-            result['checks'] = dictsum(result['checks'], item_res['checks'])
+        checks = result['checks']
+        for item_res in values:
+            # accumulate in place rather than building a new dict per child
+            for check, count in item_res['checks'].iteritems():
+                checks[check] = checks.get(check, 0) + count
             result['unit_count'] += item_res['unit_count']
 
         return result
 
+    def _calc_many(self, names, from_update=False, children_cached=None):
+        """calculate `names` values out of own stats and children's cached
+        values, which are all fetched in a single pass over the children
+        unless they are given as `children_cached`
+        """
+        if children_cached is None:
+            self.initialize_children()
+            children_cached = get_many_cached(self.children, names,
+                                              from_update)
+
+        methods = {
+            CachedMethods.LAST_ACTION: self._calc_last_action,
+            CachedMethods.LAST_UPDATED: self._calc_last_updated,
+            CachedMethods.CHECKS: self._calc_checks,
+            CachedMethods.MTIME: self._calc_mtime,
+        }
+
+        result = {}
+        for name in names:
+            # Extract the values in C; `sum()` and `max()` then iterate them
+            # without any Python bytecode per child (`_calc_checks()` still
+            # loops in Python)
+            values = imap(itemgetter(name), children_cached)
+            method = methods.get(name, None)
+            if method is None:
+                result[name] = self._calc_sum(name, values)
+            else:
+                result[name] = method(values)
+
+        return result
+
     def _calc(self, name, from_update=False):
-        return {
-            CachedMethods.TOTAL: self._calc_sum(CachedMethods.TOTAL,
-                                                from_update),
-            CachedMethods.TRANSLATED: self._calc_sum(CachedMethods.TRANSLATED,
-                                                     from_update),
-            CachedMethods.FUZZY: self._calc_sum(CachedMethods.FUZZY,
-                                                from_update),
-            CachedMethods.SUGGESTIONS: self._calc_sum(CachedMethods.SUGGESTIONS,
-                                                      from_update),
-            CachedMethods.LAST_ACTION: self._calc_last_action(from_update),
-            CachedMethods.LAST_UPDATED: self._calc_last_updated(from_update),
-            CachedMethods.CHECKS: self._calc_checks(from_update),
-            CachedMethods.MTIME: self._calc_mtime(from_update),
-        }.get(name, None)
+        return self._calc_many((name, ), from_update)[name]
 
     def get_critical_url(self):
-        critical = ','.join(get_qualitychecks_by_category(Category.CRITICAL))
-        return self.get_translate_url(check=critical)
+        global _critical_checks
+        if _critical_checks is None:
+            # The check categories don't change at runtime, and finding
+            # them out runs every quality check
+            _critical_checks = ','.join(
+                get_qualitychecks_by_category(Category.CRITICAL)
+            )
+
+        return self.get_translate_url(check=_critical_checks)
+
+    def _get_stats_from_cached(self, cached, is_dirty):
+        """build a stats dict out of the `cached` values"""
+        return {
+            'total': cached[CachedMethods.TOTAL],
+            'translated': cached[CachedMethods.TRANSLATED],
+            'fuzzy': cached[CachedMethods.FUZZY],
+            'suggestions': cached[CachedMethods.SUGGESTIONS],
+            'lastaction': cached[CachedMethods.LAST_ACTION],
+            'critical': cached[CachedMethods.CHECKS].get('unit_count', 0),
+            'lastupdated': cached[CachedMethods.LAST_UPDATED],
+            'is_dirty': is_dirty,
+        }
 
     def get_stats(self, include_children=True):
         """get stats for self and - optionally - for children"""
-        self.initialize_children()
+        children = list(self.children)
 
-        result = {
-            'total': self._calc(CachedMethods.TOTAL),
-            'translated': self._calc(CachedMethods.TRANSLATED),
-            'fuzzy': self._calc(CachedMethods.FUZZY),
-            'suggestions': self._calc(CachedMethods.SUGGESTIONS),
-            'lastaction': self._calc(CachedMethods.LAST_ACTION),
-            'critical': self.get_error_unit_count(),
-            'lastupdated': self._calc(CachedMethods.LAST_UPDATED),
-            'is_dirty': self.is_dirty(),
-        }
+        # The children's cached values and dirty states are read once and
+        # reused for both the aggregated and the per-child stats
+        children_cached = get_many_cached(children, STATS_METHODS)
+        children_dirty = get_many_dirty(children)
+
+        result = self._get_stats_from_cached(
+            self._calc_many(STATS_METHODS, children_cached=children_cached),
+            any(children_dirty),
+        )
 
         if include_children:
             result['children'] = {}
-            for item in self.children:
-                code = (self._get_code(item) if hasattr(self, '_get_code')
-                                             else item.code)
-                result['children'][code] = item.get_stats(False)
+            for item, cached, is_dirty in zip(children, children_cached,
+                                              children_dirty):
+                code = self._get_code(item)
+                result['children'][code] = \
+                    item._get_stats_from_cached(cached, is_dirty)
 
         return result
 
@@ -258,28 +354,44 @@ class CachedTreeItem(TreeItem):
         self._dirty_cache = set()
         super(CachedTreeItem, self).__init__()
 
+    def _get_cachekeys(self, names):
+        """Get a `{name: cachekey}` dict for the cached method `names`"""
+        # `:` is a reserved character, so the item key can be encoded once
+        prefix = iri_to_uri(self.get_cachekey()) + ":"
+        return dict((name, prefix + name) for name in names)
+
     def set_cached_value(self, name, value):
-        key = iri_to_uri(self.get_cachekey() + ":" + name)
+        key = self._get_cachekeys([name])[name]
         return cache.set(key, value, None)
 
     def get_cached_value(self, name):
-        key = iri_to_uri(self.get_cachekey() + ":" + name)
+        key = self._get_cachekeys([name])[name]
         return cache.get(key)
 
+    def set_cached_values(self, values):
+        """set all the `{name: value}` cached values in a single request"""
+        cachekeys = self._get_cachekeys(values)
+        cache.set_many(dict((cachekeys[name], value)
+                            for name, value in values.iteritems()), None)
+
     @statslog
-    def update_cached(self, name):
-        """calculate stat value and update cached value"""
-        self.set_cached_value(name, self._calc(name, from_update=True))
+    def update_cached(self, *names):
+        """calculate stat values and update cached values"""
+        self.set_cached_values(self._calc_many(names, from_update=True))
 
     def get_cached(self, name, from_update=False):
         """get stat value from cache"""
-        result = self.get_cached_value(name)
+        return self._get_cached_or_initial(name, self.get_cached_value(name),
+                                           from_update)
+
+    def _get_cached_or_initial(self, name, result, from_update=False):
+        """handle a cache miss for the `name` cached value"""
+        # Misses are never recalculated here: stats are only calculated by
+        # the RQ worker (`update_cached()`), so concurrent requests missing
+        # the same key can't stampede the DB and need no locking
         if result is None:
-            logging.error(
-                "cache miss %s for %s(%s)" % (name,
-                                              self.get_cachekey(),
-                                              self.__class__),
-            )
+            logging.error("cache miss %s for %s(%s)",
+                          name, self.get_cachekey(), self.__class__)
             if not from_update:
                 # get initial (empty, zero) value
                 result = getattr(CachedTreeItem, '_%s' % name)()
@@ -293,37 +405,34 @@ class CachedTreeItem(TreeItem):
         """get stats for self and - optionally - for children"""
         self.initialize_children()
 
-        result = {
-            'total': self.get_cached(CachedMethods.TOTAL),
-            'translated': self.get_cached(CachedMethods.TRANSLATED),
-            'fuzzy': self.get_cached(CachedMethods.FUZZY),
-            'suggestions': self.get_cached(CachedMethods.SUGGESTIONS),
-            'lastaction': self.get_cached(CachedMethods.LAST_ACTION),
-            'critical': self.get_error_unit_count(),
-            'lastupdated': self.get_cached(CachedMethods.LAST_UPDATED),
-            'is_dirty': self.is_dirty(),
-        }
+        items = [self]
+        if include_children:
+            items.extend(self.children)
+
+        # Fetch the cached values and dirty states for self and all children
+        # at once instead of several requests per item
+        all_cached = get_many_cached(items, STATS_METHODS)
+        all_dirty = get_many_dirty(items)
+        result = self._get_stats_from_cached(all_cached[0], all_dirty[0])
 
         if include_children:
             result['children'] = {}
-            for item in self.children:
-                code = (self._get_code(item) if hasattr(self, '_get_code')
-                                             else item.code)
-                result['children'][code] = item.get_stats(False)
+            for item, cached, is_dirty in zip(items[1:], all_cached[1:],
+                                              all_dirty[1:]):
+                code = self._get_code(item)
+                result['children'][code] = \
+                    item._get_stats_from_cached(cached, is_dirty)
 
         return result
 
     def refresh_stats(self, include_children=True):
         """refresh cached stats for self and for children"""
-        self.initialize_children()
-
         if include_children:
             for item in self.children:
                 # note that refresh_stats for a Store object does nothing
-                item.refresh_stats()
+                item.refresh_stats(include_children=True)
 
-        for name in CachedMethods.get_all():
-            self.update_cached(name)
+        self.update_cached(*CachedMethods.get_all())
 
     def get_error_unit_count(self):
         check_stats = self.get_cached(CachedMethods.CHECKS)
@@ -336,26 +445,43 @@ class CachedTreeItem(TreeItem):
 
     def mark_dirty(self, *args):
         """Mark cached method names for this TreeItem as dirty"""
-        for key in args:
-            self._dirty_cache.add(key)
+        self._dirty_cache.update(args)
 
     def mark_all_dirty(self):
         """Mark all cached method names for this TreeItem as dirty"""
-        all_cache_methods = CachedMethods.get_all()
-        self._dirty_cache = set(all_cache_methods)
+        self._dirty_cache.update(CachedMethods.get_all())
 
-    def _clear_cache(self, keys, parents=True, children=False):
-        itemkey = self.get_cachekey()
-        for key in keys:
-            cachekey = iri_to_uri(itemkey + ":" + key)
-            cache.delete(cachekey)
-        if keys:
-            log("%s deleted from %s cache" % (keys, itemkey))
+    def get_ancestors(self):
+        """Get all ancestors of the current TreeItem, nearest first"""
+        ancestors = []
+        parents = self.get_parents()
+        while parents:
+            # TreeItems have a single parent at most
+            parent = parents[0]
+            ancestors.append(parent)
+            parents = parent.get_parents()
 
+        return ancestors
+
+    def _clear_cache(self, keys, parents=True, children=False):
+        items = [self]
         if parents:
-            parents = self.get_parents()
-            for p in parents:
-                p._clear_cache(keys, parents=parents, children=False)
+            items.extend(self.get_ancestors())
+
+        if keys:
+            # `keys` may be the live dirty set, which is cleared right after,
+            # so log a snapshot of it in case the record is formatted later
+            logged_keys = None
+            if logging.getLogger('action').isEnabledFor(logging.INFO):
+                logged_keys = sorted(keys)
+
+            cachekeys = []
+            for item in items:
+                cachekeys.extend(item._get_cachekeys(keys).values())
+                if logged_keys is not None:
+                    log("%s deleted from %s cache", logged_keys,
+                        item.get_cachekey())
+            cache.delete_many(cachekeys)
 
         if children:
             self.initialize_children()
@@ -365,7 +491,7 @@ class CachedTreeItem(TreeItem):
     def clear_dirty_cache(self, parents=True, children=False):
         self._clear_cache(self._dirty_cache,
                           parents=parents, children=children)
-        self._dirty_cache = set()
+        self._dirty_cache.clear()
 
     def clear_all_cache(self, children=True, parents=True):
         all_cache_methods = CachedMethods.get_all()
@@ -383,8 +509,10 @@ class CachedTreeItem(TreeItem):
     def is_being_refreshed(self):
         """Checks if current TreeItem is being refreshed"""
         r_con = get_connection()
-        path = r_con.get(POOTLE_REFRESH_STATS)
+        return self._is_being_refreshed(r_con.get(POOTLE_REFRESH_STATS))
 
+    def _is_being_refreshed(self, path):
+        """Checks if current TreeItem is within the `path` being refreshed"""
         if path is not None:
             if path == '/':
                 return True
@@ -419,9 +547,9 @@ class CachedTreeItem(TreeItem):
         """Add a RQ job which updates dirty cached stats of current TreeItem
         to the default queue
         """
-        _dirty = self._dirty_cache.copy()
-        if _dirty:
-            self._dirty_cache = set()
+        if self._dirty_cache:
+            # hand the current set over to the job instead of copying it
+            _dirty, self._dirty_cache = self._dirty_cache, set()
             self.register_dirty()
             update_cache.delay(self, _dirty)
 
@@ -433,12 +561,10 @@ class CachedTreeItem(TreeItem):
         self.update_dirty_cache()
 
     def _update_cache(self, keys):
-        """Update dirty cached stats of current TreeItem"""
-        for key in keys:
-            self.update_cached(key)
-        self.unregister_dirty()
-        for p in self.get_parents():
-            p._update_cache(keys)
+        """Update dirty cached stats of current TreeItem and its ancestors"""
+        for item in [self] + self.get_ancestors():
+            item.update_cached(*keys)
+            item.unregister_dirty()
 
     def update_parent_cache(self, exclude_self=False):
         """Update dirty cached stats for a all parents of the current TreeItem"""
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Evernote Corporation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+
+class FakeRedis(object):
+    """In-memory stand-in for the Redis calls made by TreeItems.
+
+    `round_trips` counts the requests that would hit the server.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.zsets = {}
+        self.round_trips = 0
+
+    def _get(self, key):
+        return self.data.get(key)
+
+    def _zscore(self, name, value):
+        return self.zsets.get(name, {}).get(value)
+
+    def _zincrby(self, name, value, amount=1):
+        zset = self.zsets.setdefault(name, {})
+        zset[value] = zset.get(value, 0) + amount
+        return zset[value]
+
+    def get(self, key):
+        self.round_trips += 1
+        return self._get(key)
+
+    def zscore(self, name, value):
+        self.round_trips += 1
+        return self._zscore(name, value)
+
+    def zincrby(self, name, value, amount=1):
+        self.round_trips += 1
+        return self._zincrby(name, value, amount)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append((self.redis._get, (key, )))
+
+    def zscore(self, name, value):
+        self.commands.append((self.redis._zscore, (name, value)))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [command(*args) for command, args in self.commands]
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Replace the TreeItem Redis connection with an in-memory one."""
+    from pootle.core.mixins import treeitem
+
+    connection = FakeRedis()
+    monkeypatch.setattr(treeitem, 'get_connection', lambda: connection)
+
+    return connection
+
+
+def _cache_stats(item, total, critical):
+    """Store a full set of stats for `item` in the cache."""
+    from pootle.core.mixins import CachedMethods
+
+    item.set_cached_values({
+        CachedMethods.TOTAL: total,
+        CachedMethods.TRANSLATED: total - 2,
+        CachedMethods.FUZZY: 1,
+        CachedMethods.SUGGESTIONS: 3,
+        CachedMethods.LAST_ACTION: {'id': total, 'mtime': total,
+                                    'snippet': ''},
+        CachedMethods.LAST_UPDATED: {'id': total, 'creation_time': total,
+                                     'snippet': ''},
+        CachedMethods.CHECKS: {'unit_count': critical,
+                               'checks': {'printf': critical}},
+    })
+
+
+def _get_expected_stats(total, critical, is_dirty=False):
+    """Get the stats matching the ones stored by `_cache_stats()`."""
+    return {
+        'total': total,
+        'translated': total - 2,
+        'fuzzy': 1,
+        'suggestions': 3,
+        'lastaction': {'id': total, 'mtime': total, 'snippet': ''},
+        'critical': critical,
+        'lastupdated': {'id': total, 'creation_time': total, 'snippet': ''},
+        'is_dirty': is_dirty,
+    }
+
+
+@pytest.mark.django_db
+def test_get_stats_without_children(fake_redis, af_tutorial_po):
+    """Tests only own stats are returned without `include_children`."""
+    tp = af_tutorial_po.translation_project
+    _cache_stats(tp, 10, 3)
+    _cache_stats(af_tutorial_po, 4, 1)
+
+    assert tp.get_stats(include_children=False) == _get_expected_stats(10, 3)
+
+
+@pytest.mark.django_db
+def test_get_stats_with_children(fake_redis, af_tutorial_po):
+    """Tests children stats are returned keyed by their codes."""
+    tp = af_tutorial_po.translation_project
+    _cache_stats(tp, 10, 3)
+    _cache_stats(af_tutorial_po, 4, 1)
+
+    stats = tp.get_stats()
+    children = stats.pop('children')
+
+    assert stats == _get_expected_stats(10, 3)
+    assert sorted(children) == sorted(item.code for item in tp.children)
+    assert children['tutorial-po'] == _get_expected_stats(4, 1)
+
+
+@pytest.mark.django_db
+def test_get_stats_cache_miss(fake_redis, af_tutorial_po):
+    """Tests initial values are returned for stats missing in the cache."""
+    from pootle.core.mixins import CachedMethods
+
+    # Creating the store has already cached its initial values
+    af_tutorial_po.clear_all_cache(children=False, parents=False)
+    for name in CachedMethods.get_all():
+        assert af_tutorial_po.get_cached_value(name) is None
+
+    stats = af_tutorial_po.get_stats()
+
+    assert stats == {
+        'total': 0,
+        'translated': 0,
+        'fuzzy': 0,
+        'suggestions': 0,
+        'lastaction': {'id': 0, 'mtime': 0, 'snippet': ''},
+        'critical': 0,
+        'lastupdated': {'id': 0, 'creation_time': 0, 'snippet': ''},
+        'is_dirty': False,
+        'children': {},
+    }
+
+
+@pytest.mark.django_db
+def test_get_stats_is_dirty(fake_redis, af_tutorial_po):
+    """Tests the dirty state is reported for each item."""
+    from pootle.core.mixins.treeitem import (POOTLE_DIRTY_TREEITEMS,
+                                             POOTLE_REFRESH_STATS)
+
+    tp = af_tutorial_po.translation_project
+    fake_redis.zincrby(POOTLE_DIRTY_TREEITEMS, af_tutorial_po.get_cachekey())
+
+    stats = tp.get_stats()
+    assert not stats['is_dirty']
+    assert stats['children']['tutorial-po']['is_dirty']
+
+    # Refreshing the whole tree makes every item dirty
+    fake_redis.data[POOTLE_REFRESH_STATS] = '/'
+
+    stats = tp.get_stats()
+    assert stats['is_dirty']
+    assert all(child['is_dirty'] for child in stats['children'].values())
+
+
+@pytest.mark.django_db
+def test_get_stats_batches_requests(fake_redis, monkeypatch, af_tutorial_po):
+    """Tests stats for an item and its children are read with a single
+    cache request and a single Redis round-trip.
+    """
+    from pootle.core.mixins import treeitem
+
+    get_many_calls = []
+    get_many = treeitem.cache.get_many
+
+    def _get_many(keys, *args, **kwargs):
+        get_many_calls.append(keys)
+        return get_many(keys, *args, **kwargs)
+
+    monkeypatch.setattr(treeitem.cache, 'get_many', _get_many)
+
+    tp = af_tutorial_po.translation_project
+    tp.initialize_children()
+    fake_redis.round_trips = 0
+
+    tp.get_stats()
+
+    assert len(get_many_calls) == 1
+    assert fake_redis.round_trips == 1
+
+
+@pytest.mark.django_db
+def test_project_resource_get_stats(fake_redis, af_tutorial_po):
+    """Tests virtual resources aggregate their resources' stats and
+    report them keyed by the codes given by `_get_code()`.
+    """
+    from pootle_project.models import ProjectResource
+
+    _cache_stats(af_tutorial_po, 4, 1)
+    resource = ProjectResource([af_tutorial_po],
+                               '/projects/tutorial/tutorial.po')
+
+    stats = resource.get_stats()
+
+    assert stats.pop('children') == {'af': _get_expected_stats(4, 1)}
+    assert stats == _get_expected_stats(4, 1)
+
+
+def _get_item_ids(items):
+    """Identify `items` by class, as TPs share cache keys with their
+    directories.
+    """
+    return [(item.__class__.__name__, item.get_cachekey()) for item in items]
+
+
+@pytest.mark.django_db
+def test_get_ancestors(af_tutorial_po):
+    """Tests ancestors are returned nearest first."""
+    tp = af_tutorial_po.translation_project
+
+    assert _get_item_ids(af_tutorial_po.get_ancestors()) == \
+        _get_item_ids([tp, tp.project])
+    assert tp.project.get_ancestors() == []
+
+
+@pytest.mark.django_db
+def test_clear_cache_parents(fake_redis, monkeypatch, af_tutorial_po):
+    """Tests clearing the cache with `parents` clears self and every
+    ancestor exactly once, nearest first.
+    """
+    from pootle.core.mixins import CachedMethods, CachedTreeItem
+
+    tp = af_tutorial_po.translation_project
+    items = [af_tutorial_po, tp, tp.project]
+    for item in items:
+        item.init_cache()
+
+    cleared = []
+    get_cachekeys = CachedTreeItem._get_cachekeys
+
+    def _get_cachekeys(self, names):
+        cleared.append(self)
+        return get_cachekeys(self, names)
+
+    monkeypatch.setattr(CachedTreeItem, '_get_cachekeys', _get_cachekeys)
+
+    af_tutorial_po._clear_cache([CachedMethods.TOTAL], parents=True)
+
+    assert _get_item_ids(cleared) == _get_item_ids(items)
+    for item in items:
+        assert item.get_cached_value(CachedMethods.TOTAL) is None
+        assert item.get_cached_value(CachedMethods.FUZZY) is not None
+
+
+@pytest.mark.django_db
+def test_update_cache_parents(fake_redis, monkeypatch, af_tutorial_po):
+    """Tests updating the cache updates and unregisters self and every
+    ancestor exactly once, nearest first.
+    """
+    from pootle.core.mixins import CachedMethods, CachedTreeItem
+    from pootle.core.mixins.treeitem import POOTLE_DIRTY_TREEITEMS
+
+    tp = af_tutorial_po.translation_project
+    items = [af_tutorial_po, tp, tp.project]
+
+    updated = []
+
+    def _update_cached(self, *names):
+        updated.append((self, names))
+
+    monkeypatch.setattr(CachedTreeItem, 'update_cached', _update_cached)
+
+    keys = set([CachedMethods.TOTAL, CachedMethods.CHECKS])
+    af_tutorial_po._update_cache(keys)
+
+    assert _get_item_ids(item for item, names in updated) == \
+        _get_item_ids(items)
+    assert all(set(names) == keys for item, names in updated)
+    assert fake_redis.zsets[POOTLE_DIRTY_TREEITEMS] == \
+        dict((item.get_cachekey(), -1) for item in items)
+
+
+def _init_children_cache(item):
+    """Store initial values for all cached stats of `item`'s children and
+    clear `item`'s own cached stats.
+    """
+    from pootle.core.mixins import CachedMethods
+
+    for child in item.children:
+        child.init_cache()
+
+    # Creating `item` has already cached its initial values
+    item.clear_all_cache(children=False, parents=False)
+    for name in CachedMethods.get_all():
+        assert item.get_cached_value(name) is None
+
+
+@pytest.mark.django_db
+def test_update_cached_all(fake_redis, af_tutorial_po):
+    """Tests updating all cached methods writes every cached value."""
+    from pootle.core.mixins import CachedMethods
+
+    tp = af_tutorial_po.translation_project
+    _init_children_cache(tp)
+    _cache_stats(af_tutorial_po, 4, 1)
+
+    tp.update_cached(*CachedMethods.get_all())
+
+    for name in CachedMethods.get_all():
+        assert tp.get_cached_value(name) is not None
+    assert tp.get_cached_value(CachedMethods.TOTAL) == 4
+    assert tp.get_cached_value(CachedMethods.CHECKS) == \
+        {'unit_count': 1, 'checks': {'printf': 1}}
+
+
+@pytest.mark.django_db
+def test_update_cached_some(fake_redis, af_tutorial_po):
+    """Tests updating some cached methods writes only their values."""
+    from pootle.core.mixins import CachedMethods
+
+    tp = af_tutorial_po.translation_project
+    _init_children_cache(tp)
+
+    tp.update_cached(CachedMethods.TOTAL, CachedMethods.FUZZY)
+
+    for name in CachedMethods.get_all():
+        is_cached = tp.get_cached_value(name) is not None
+        assert is_cached == (name in (CachedMethods.TOTAL,
+                                      CachedMethods.FUZZY))
+
+
+@pytest.mark.django_db
+def test_calc_many_only_requested(fake_redis, monkeypatch, af_tutorial_po):
+    """Tests only the requested stats are calculated."""
+    from pootle.core.mixins import CachedMethods
+
+    tp = af_tutorial_po.translation_project
+    _init_children_cache(tp)
+
+    calculated = []
+
+    def _record(name, method):
+        def _method(*args, **kwargs):
+            calculated.append(name)
+            return method(*args, **kwargs)
+        return _method
+
+    for name in CachedMethods.get_all():
+        method_name = '_%s' % name
+        monkeypatch.setattr(tp, method_name,
+                            _record(name, getattr(tp, method_name)))
+
+    names = (CachedMethods.TOTAL, CachedMethods.CHECKS)
+    result = tp._calc_many(names)
+
+    assert sorted(result) == sorted(names)
+    assert sorted(calculated) == sorted(names)
+
+
+@pytest.mark.django_db
+def test_calc_checks_many_children(fake_redis, af_tutorial_po,
+                                   af_tutorial_subdir_po):
+    """Tests quality check counts are summed across all children."""
+    from pootle.core.mixins import CachedMethods
+    from pootle_project.models import ProjectResource
+
+    af_tutorial_po.set_cached_value(CachedMethods.CHECKS, {
+        'unit_count': 3,
+        'checks': {'printf': 2, 'endpunc': 1},
+    })
+    af_tutorial_subdir_po.set_cached_value(CachedMethods.CHECKS, {
+        'unit_count': 4,
+        'checks': {'printf': 1, 'xmltags': 3},
+    })
+    resource = ProjectResource([af_tutorial_po, af_tutorial_subdir_po],
+                               '/projects/tutorial/')
+
+    expected = {
+        'unit_count': 7,
+        'checks': {'printf': 3, 'endpunc': 1, 'xmltags': 3},
+    }
+    assert resource._calc_many([CachedMethods.CHECKS]) == \
+        {CachedMethods.CHECKS: expected}
+    # Merging in place must not accumulate across calculations
+    assert resource._calc_many([CachedMethods.CHECKS]) == \
+        {CachedMethods.CHECKS: expected}
+    assert resource.get_error_unit_count() == 7